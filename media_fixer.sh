@@ -8,7 +8,6 @@
 MEDIAINFO_EXE=$(which mediainfo)
 # where is your "ffmpeg" executable
 FFMPEG_EXE=$(which ffmpeg)
-CP_EXE=$(which cp)
 MV_EXE=$(which mv)
 RM_EXE=$(which rm)
 
@@ -30,6 +29,17 @@ else
 	CONTAINER_EXTENSION="mkv"
 fi
 
+# Options specific to the container
+case "${CONTAINER_EXTENSION}" in
+	mp4|m4v|mov)
+		# put the index at the beginning of the file, so that streaming can start right away
+		FFMPEG_MUX_OPTS="-movflags +faststart"
+		;;
+	*)
+		FFMPEG_MUX_OPTS=
+		;;
+esac
+
 # Which codec to use for re-encoding if needed
 if [ "${MEDIAFIXER_VIDEO_CODEC}" != "" ]
 then
@@ -57,21 +67,62 @@ if [ "${MEDIAFIXER_FFMPEG_EXTRA_OPTS}" != "" ]
 then
 	FFMPEG_EXTRA_OPTS="${MEDIAFIXER_FFMPEG_EXTRA_OPTS}"
 else
-	FFMPEG_EXTRA_OPTS="-fflags +genpts"
+	# the videos have already been analyzed by mediainfo, so ffmpeg can probe the input a lot less
+	FFMPEG_EXTRA_OPTS="-fflags +genpts -probesize 5000000 -analyzeduration 500000"
 fi
 
 if [ "${MEDIAFIXER_FFMPEG_ENCODE}" != "" ]
 then
 	FFMPEG_ENCODE="${MEDIAFIXER_FFMPEG_ENCODE}"
 else
-	FFMPEG_ENCODE="-c:v libsvtav1 -crf 38"
+	FFMPEG_ENCODE="-c:V libsvtav1 -crf 38"
 fi
 
 if [ "${MEDIAFIXER_FFMPEG_RESIZE}" != "" ]
 then
 	FFMPEG_RESIZE="${MEDIAFIXER_FFMPEG_RESIZE}"
 else
-	FFMPEG_RESIZE="-vf scale=${VIDEO_WIDTH}:${VIDEO_HEIGHT}"
+	FFMPEG_RESIZE="-filter:V scale=${VIDEO_WIDTH}:${VIDEO_HEIGHT}"
+fi
+
+# Use a GPU encoder, if one is available for VIDEO_CODEC (only when FFMPEG_ENCODE is not customized)
+if [ "${MEDIAFIXER_HW_ENCODE}" != "" ]
+then
+	HW_ENCODE="${MEDIAFIXER_HW_ENCODE}"
+else
+	HW_ENCODE=0
+fi
+
+# How many videos to convert at the same time
+if [ "${MEDIAFIXER_JOBS}" != "" ]
+then
+	JOBS="${MEDIAFIXER_JOBS}"
+else
+	JOBS=1
+fi
+
+# How many threads each ffmpeg can use, 0 lets ffmpeg decide (or share the CPUs between the jobs)
+if [ "${MEDIAFIXER_FFMPEG_THREADS}" != "" ]
+then
+	FFMPEG_THREADS="${MEDIAFIXER_FFMPEG_THREADS}"
+else
+	FFMPEG_THREADS=0
+fi
+
+# Files with these extensions are assumed to be videos, all the others are checked with "file"
+if [ "${MEDIAFIXER_VIDEO_EXTENSIONS}" != "" ]
+then
+	VIDEO_EXTENSIONS="${MEDIAFIXER_VIDEO_EXTENSIONS}"
+else
+	VIDEO_EXTENSIONS="mkv mp4 m4v avi mov webm wmv flv mpg mpeg ts mts 3gp"
+fi
+
+# How many videos to analyze in parallel while building the queues
+if [ "${MEDIAFIXER_SCAN_JOBS}" != "" ]
+then
+	SCAN_JOBS="${MEDIAFIXER_SCAN_JOBS}"
+else
+	SCAN_JOBS=$(nproc 2> /dev/null || echo 1)
 fi
 
 # loggig and general print functions
@@ -179,15 +230,6 @@ function print_wait
 	__print_wait_state=$(( __print_wait_state+1 ))
 }
 
-function trim() {
-    local var="$*"
-    # remove leading whitespace characters
-    var="${var#"${var%%[![:space:]]*}"}"
-    # remove trailing whitespace characters
-    var="${var%"${var##*[![:space:]]}"}"
-    printf '%s' "$var"
-}
-
 function exec_command
 {
         print_log "- running command: '""$@""'"
@@ -199,64 +241,275 @@ function exec_command
         fi
 }
 
+# Like exec_command, but only the last lines of the ffmpeg output are logged,
+# since the progress updates of a long encoding would fill the log file.
+FFMPEG_LOG_LINES=200
+function exec_ffmpeg
+{
+	print_log "- running command: '""$@""'"
+	if [ ${TEST_ONLY} -eq 1 ]
+	then
+		print_notice " (command not executed because TEST_ONLY=1) "
+	else
+		# ffmpeg updates its progress with carriage returns, split them in lines
+		"$@" 2>&1 | tr '\r' '\n' | tail -n ${FFMPEG_LOG_LINES} >> "${LOG_FILE}"
+		return ${PIPESTATUS[0]}
+	fi
+}
 
+# Store in the variable named $1 the value $2 without leading and trailing whitespaces, without a subshell
+function trim_to
+{
+	local value="$2"
+	value="${value#"${value%%[![:space:]]*}"}"
+	printf -v "$1" '%s' "${value%"${value##*[![:space:]]}"}"
+}
+
+# Find the value of row in section, from the output of mediainfo
 function parse_mediainfo_output
 {
-	local filename=$1
-	local section=$2
-	local row=$3
+	local output="$1"
+	local section="$2"
+	local row="$3"
 
-	local value=
+	local line=
+	local left=
 	local section_found=0
-	local row_found=0
-	export mediainfo_value=$("${MEDIAINFO_EXE}" "$filename" | while read line
+	mediainfo_value=
+	while IFS= read -r line
 	do
 		if [ $section_found -eq 0 ]
 		then
 			test "$line" = "$section" && section_found=1
+		elif [ -z "$line" ]
+		then
+			break
 		else
-			if [ -z "$line" ]
+			trim_to left "${line%%:*}"
+			if [ "${left}" = "$row" ]
 			then
-				return 255
-			else
-				local left=
-				local right=
-				IFS=: read left right <<< "$line"
-				if [ "$(trim "$left")" = "$row" ]
-				then
-					echo $(trim "$right")
-					return 0
-				fi
+				trim_to mediainfo_value "${line#*:}"
+				return 0
 			fi
 		fi
-	done)
-	
-	if [ $? -eq 0 ]
-	then
-		return 0
-	else
-		echo "ERROR: '$row' in '$section' not found"
-		return 255
-	fi
+	done <<< "${output}"
+
+	echo "ERROR: '$row' in '$section' not found"
+	return 255
+}
+
+# Set convert_subtitles to 1 if some subtitles must be converted to SRT, from the output of mediainfo,
+# and subtitles_tracks to the comma separated indexes of the subtitle streams to convert ("-" if none).
+# SRT, ASS and SSA are copied as they are, and so are image based subtitles (PGS, VobSub...) which cannot be
+# converted to text at all. Other text subtitles (like MP4 Timed Text) are converted.
+# mediainfo lists the Text tracks in the same order as ffmpeg numbers the subtitle streams, but it also lists
+# closed captions carried inside the video stream (like EIA-608 in TV recordings), which ffmpeg does not
+# expose as subtitle streams: those are not counted.
+function parse_mediainfo_subtitles
+{
+	local output="$1"
+
+	local line=
+	local left=
+	local right=
+	local in_text=0
+	local format= id= muxing=
+	local track=-1
+	convert_subtitles=0
+	subtitles_tracks=
+	# an empty line is appended, so that the last track is handled too
+	while IFS= read -r line
+	do
+		case "${line}" in
+			"Text"|"Text #"*)
+				in_text=1
+				format=
+				id=
+				muxing=
+				;;
+			"")
+				test $in_text -eq 1 || continue
+				in_text=0
+				# captions embedded in the video have an ID like "1-CC1" and a caption transport as muxing mode
+				case "${id}|${muxing}" in
+					*-*"|"*|*"|"*"A/53"*|*"|"*SCTE*|*"|"*DTVCC*|*"|"*SEI*)
+						continue
+						;;
+				esac
+				track=$(( track + 1 ))
+				case "${format}" in
+					UTF-8|ASS|SSA|PGS|VobSub|"DVB Subtitle")
+						;;
+					*)
+						convert_subtitles=1
+						subtitles_tracks="${subtitles_tracks}${subtitles_tracks:+,}${track}"
+						;;
+				esac
+				;;
+			*)
+				test $in_text -eq 1 || continue
+				trim_to left "${line%%:*}"
+				trim_to right "${line#*:}"
+				case "${left}" in
+					Format)
+						format="${right}"
+						;;
+					ID)
+						id="${right}"
+						;;
+					"Muxing mode")
+						muxing="${right}"
+						;;
+				esac
+				;;
+		esac
+	done <<< "${output}"$'\n'
+	test "${subtitles_tracks}" = "" && subtitles_tracks="-"
 }
 
 function count_lines()
 {
 	local filename="$1"
-	cat ${filename} | wc -l
+	wc -l < "${filename}"
 }
 
+# Queue lines are not removed from the queue file as soon as they are popped, since that means rewriting
+# the whole file each time: the offset of the first line still in the queue, and how many lines have been
+# popped, are stored in <queue>.offset, and the popped lines are removed once every QUEUE_COMPACT_LINES.
+QUEUE_COMPACT_LINES=1000
+
+# Remove the popped lines from the queue file
+function queue_compact()
+{
+	local filename="$1"
+	local offset=0
+	local popped=0
+
+	test -e "${filename}".offset || return 0
+	read -r offset popped < "${filename}".offset
+	tail -c +$(( offset + 1 )) "${filename}" > "${filename}".removal_in_progress
+	"${MV_EXE}" "${filename}".removal_in_progress "${filename}"
+	"${RM_EXE}" -f "${filename}".offset
+}
+
+# Pop the first line of the queue into queue_line (empty when the queue is empty)
 function queue_pop_line()
 {
 	local filename="$1"
-	local line=$(head -n 1 ${filename})
-	tail -n +2 ${filename} > ${filename}.removal_in_progress
-	"${MV_EXE}" ${filename}.removal_in_progress ${filename}
-	echo ${line}
+	local offset=0
+	local popped=0
+	# count the line length in bytes, not characters
+	local LC_ALL=C
+
+	test -e "${filename}".offset && read -r offset popped < "${filename}".offset
+	queue_line=
+	IFS= read -r queue_line < <(tail -c +$(( offset + 1 )) "${filename}")
+	if [ "${queue_line}" = "" ]
+	then
+		queue_compact "${filename}"
+		return 0
+	fi
+
+	echo "$(( offset + ${#queue_line} + 1 )) $(( popped + 1 ))" > "${filename}".offset
+	test $(( popped + 1 )) -ge ${QUEUE_COMPACT_LINES} && queue_compact "${filename}"
+	return 0
+}
+
+# The mediainfo cache remembers the analysis of each video between runs.
+# One line per video: modification time and size, container, video codec, video height, subtitles conversion (0 or 1),
+# subtitle streams to convert ("-" if none) and full path, separated by tabs.
+# A video is analyzed again only if its modification time or size has changed.
+declare -A mediainfo_cache
+
+function mediainfo_cache_load()
+{
+	local filename="$1"
+	local stat container codec height subtitles tracks path
+
+	test -e "${filename}" || return 0
+	while IFS=$'\t' read -r stat container codec height subtitles tracks path
+	do
+		# skip lines written by older versions, which did not store the subtitles conversion
+		test "${subtitles}" = "0" -o "${subtitles}" = "1" || continue
+		test "${tracks}" = "-" -o "${tracks//[[:digit:],]/}" = "" || continue
+		test "${tracks}" != "" -a "${path}" != "" || continue
+		# forget videos which have been removed or converted in the meanwhile
+		test -e "${path}" && mediainfo_cache["${path}"]="${stat}"$'\t'"${container}"$'\t'"${codec}"$'\t'"${height}"$'\t'"${subtitles}"$'\t'"${tracks}"
+	done < "${filename}"
+
+	# rewrite the cache without the stale and duplicated lines
+	for path in "${!mediainfo_cache[@]}"
+	do
+		printf '%s\t%s\n' "${mediainfo_cache[${path}]}" "${path}"
+	done > "${filename}".compact_in_progress
+	"${MV_EXE}" "${filename}".compact_in_progress "${filename}"
+}
+
+# Set video_container, video_codec, video_height, convert_subtitles and subtitles_tracks for the given video,
+# from the cache or from mediainfo.
+# The first argument is "modification_time size" of the video, if already known.
+function analyze_video_file()
+{
+	local file_stat="$1"
+	shift
+	local full_filename="$*"
+	local path="${PWD}/${full_filename#./}"
+	test -z "${file_stat}" && file_stat=$(stat -c '%Y %s' -- "${full_filename}")
+	local stat=
+
+	IFS=$'\t' read -r stat video_container video_codec video_height convert_subtitles subtitles_tracks <<< "${mediainfo_cache[${path}]}"
+	if [ "${stat}" != "" -a "${stat}" = "${file_stat}" ]
+	then
+		print_log "Using cached analysis for '${full_filename}'"
+		return 0
+	fi
+
+	# run mediainfo only once, then parse all the values from its output
+	local mediainfo_output=
+	mediainfo_output="$("${MEDIAINFO_EXE}" "${full_filename}")"
+	if [ $? -ne 0 ]
+	then
+		print_error "Unable to run mediainfo"
+		return 255
+	fi
+
+	parse_mediainfo_output "${mediainfo_output}" "General" "Format"
+	if [ $? -ne 0 -o "${mediainfo_value}" = "" ]
+	then
+		print_error "Unable to parse General Format"
+		return 255
+	fi
+	video_container="${mediainfo_value}"
+
+	parse_mediainfo_output "${mediainfo_output}" "Video" "Format"
+	if [ $? -ne 0 -o "${mediainfo_value}" = "" ]
+	then
+		print_error "Unable to parse Video Format"
+		return 255
+	fi
+	video_codec="${mediainfo_value}"
+
+	parse_mediainfo_output "${mediainfo_output}" "Video" "Height"
+	# remove unit and blanks inside height string (since mediainfo will report 1080 as "1 080 pixels"):
+	mediainfo_value="${mediainfo_value% *}"
+	mediainfo_value=${mediainfo_value//[[:space:]]/}
+	if [ "${mediainfo_value}" = "" -o "${mediainfo_value//[[:digit:]]/}" != "" ]
+	then
+		print_error "Unable to parse Video Height"
+		return 255
+	fi
+	video_height="${mediainfo_value}"
+
+	parse_mediainfo_subtitles "${mediainfo_output}"
+
+	printf '%s\t%s\t%s\t%s\t%s\t%s\t%s\n' "${file_stat}" "${video_container}" "${video_codec}" "${video_height}" "${convert_subtitles}" "${subtitles_tracks}" "${path}" >&${cache_fd}
+	return 0
 }
 
 function preprocess_video_file()
 {
+	local file_stat="$1"
+	shift
 	local full_filename="$*"
 
 	local l_result=2 # 0= failed, 1= success, 2= skipped
@@ -266,47 +519,27 @@ function preprocess_video_file()
 
 	print_notice "Analyzing file '${full_filename}'..."
 
-	parse_mediainfo_output "${full_filename}" "General" "Format"
+	analyze_video_file "${file_stat}" "${full_filename}"
 	if [ $? -eq 0 ]
 	then
-		if [ "${mediainfo_value}" != "${CONTAINER}" ]
+		if [ "${video_container}" != "${CONTAINER}" ]
 		then
-			print_notice "   - Conversion from '${mediainfo_value}' to '${CONTAINER}' needed"
+			print_notice "   - Conversion from '${video_container}' to '${CONTAINER}' needed"
 			l_change_container=1
 		fi
 
-		parse_mediainfo_output "${full_filename}" "Video" "Format"
-		if [ $? -eq 0 ]
+		if [ "${video_codec}" != "${VIDEO_CODEC}" ]
 		then
-			if [ "${mediainfo_value}" != "${VIDEO_CODEC}" ]
-			then
-				print_notice "   - Encoding from '${mediainfo_value}' to '${VIDEO_CODEC}' needed"
-				l_encode=1
-			fi
-			parse_mediainfo_output "${full_filename}" "Video" "Height"
-			mediainfo_value="${mediainfo_value% *}"
-			if [ $? -eq 0 ]
-			then
-				# remove blanks inside height string (since mediainfo will report 1080 as "1 080"):
-				mediainfo_value=${mediainfo_value//[[:space:]]/}
-				if [ "${mediainfo_value}" != "${VIDEO_HEIGHT}" ]
-				then
-					if [ ${mediainfo_value} -gt ${VIDEO_HEIGHT} ]
-					then
-						print_notice "   - Resize from '${mediainfo_value}' to '${VIDEO_HEIGHT}' needed"
-						l_resize=1
-					fi
-				fi
-			else
-				print_error "Unable to parse Video Height"
-				l_result=0
-			fi
-		else
-			print_error "Unable to parse Video Format"
-			l_result=0
+			print_notice "   - Encoding from '${video_codec}' to '${VIDEO_CODEC}' needed"
+			l_encode=1
+		fi
+
+		if [ ${video_height} -gt ${VIDEO_HEIGHT} ]
+		then
+			print_notice "   - Resize from '${video_height}' to '${VIDEO_HEIGHT}' needed"
+			l_resize=1
 		fi
 	else
-		print_error "Unable to parse General Format"
 		l_result=0
 	fi
 
@@ -325,11 +558,275 @@ function preprocess_video_file()
 	export resize=$l_resize
 }
 
+# Set full_filename, change_container, encode, resize, convert_subtitles and subtitles_options from a queue line.
+# Queue lines are "flags path", where flags is the sum of 1 (change container), 2 (encode), 4 (resize)
+# and 8 (convert subtitles to SRT). With 8, the path is preceded by the comma separated indexes
+# of the subtitle streams to convert: "flags tracks path".
+# Lines without flags, like the ones in the failed queue, have nothing to do.
+function parse_queue_line()
+{
+	local line="$*"
+	local flags=0
+	local tracks= track=
+
+	subtitles_options=
+	case "${line}" in
+		*"|||| "[01]" "[01]" "[01])
+			# "path|||| change_container encode resize", written by older versions
+			full_filename="${line%||||*}"
+			read -r change_container encode resize <<< "${line##*||||}"
+			# older versions always converted all subtitles to SRT
+			flags=$(( change_container | encode << 1 | resize << 2 | 1 << 3 ))
+			subtitles_options=" -codec:s srt"
+			;;
+		[[:digit:]]*" "*)
+			flags="${line%% *}"
+			if [ "${flags//[[:digit:]]/}" = "" -a ${#flags} -le 2 ] && [ $(( 10#${flags} )) -le 15 ]
+			then
+				flags=$(( 10#${flags} ))
+				full_filename="${line#* }"
+			else
+				# not flags, just a path starting with a number (like "2024 Holiday.mkv")
+				flags=0
+				full_filename="${line}"
+			fi
+			;;
+		*)
+			full_filename="${line}"
+			;;
+	esac
+	change_container=$(( flags & 1 ))
+	encode=$(( flags >> 1 & 1 ))
+	resize=$(( flags >> 2 & 1 ))
+	convert_subtitles=$(( flags >> 3 & 1 ))
+
+	if [ $convert_subtitles -eq 1 -a "${subtitles_options}" = "" ]
+	then
+		tracks="${full_filename%% *}"
+		if [ "${tracks}" != "${full_filename}" -a "${tracks}" != "" -a "${tracks//[[:digit:],]/}" = "" ]
+		then
+			full_filename="${full_filename#* }"
+			for track in ${tracks//,/ }
+			do
+				subtitles_options="${subtitles_options} -codec:s:${track} srt"
+			done
+		else
+			# lines written by older versions don't tell which subtitles to convert: convert them all
+			subtitles_options=" -codec:s srt"
+		fi
+	fi
+}
+
+# Analyze one video and append it to the proper queue.
+# Runs as a background job during the scan, so it must only append to the queue files,
+# using the file descriptors opened once for the whole scan.
+# The first argument is "modification_time size" of the video, if already known.
+function scan_video_file()
+{
+	local file_stat="$1"
+	shift
+	local line="$*"
+
+	result=0
+	change_container=0
+	encode=0
+	resize=0
+	preprocess_video_file "${file_stat}" "${line}"
+
+	# Move file to appropriate new queue
+	if [ $result -eq 0 ]
+	then
+		print_log "Video '${line}' added to failed queue"
+		echo "${line}" >&${failed_fd}
+	elif [ $result -eq 2 ]
+	then
+		print_log "Video '${line}' added to skipped queue"
+		echo "${line}" >&${skipped_fd}
+	elif [ $result -eq 1 ]
+	then
+		print_log "Video '${line}' added to processing queue (${change_container} ${encode} ${resize})"
+		if [ $convert_subtitles -eq 1 ]
+		then
+			echo "$(( change_container | encode << 1 | resize << 2 | convert_subtitles << 3 )) ${subtitles_tracks} ${line}" >&${in_progress_fd}
+		else
+			echo "$(( change_container | encode << 1 | resize << 2 )) ${line}" >&${in_progress_fd}
+		fi
+	else
+		print_error "Invalid value of '$result' in result!"
+	fi
+}
+
+# Convert one video from the in_progress queue, then append it to the completed or failed queue.
+# Runs as a background job, so that up to JOBS videos can be converted at the same time,
+# and appends to the queues using the file descriptors opened once for the whole work loop.
+function process_video_line()
+{
+	local line="$*"
+	local result full_filename filepath filename extension stripped_filename
+	local change_container encode resize convert_subtitles subtitles_options
+	local my_cwd error gc_filename source_filename destination_filename ffmpeg_options
+
+	result=0
+
+	parse_queue_line "${line}"
+	filepath="${full_filename%/*}"
+	filename="${full_filename##*/}"
+	extension="${filename##*.}"
+	stripped_filename="${filename%.*}"
+
+	if [ $change_container -eq 1 -o $encode -eq 1 -o $resize -eq 1 ]
+	then
+		result=0
+		my_cwd="$PWD"
+		if cd "${filepath}"
+		then
+			error=0
+			# ffmpeg reads the original directly and writes a temporary file beside it,
+			# which replaces the original only when the conversion is successful.
+			# The temporary name keeps the original extension, so that "video.avi" and "video.mp4"
+			# in the same folder never share it.
+			gc_filename="${filename}.mediafixer_working.${CONTAINER_EXTENSION}"
+
+			source_filename="${filename}"
+			if [ ${FFMPEG_ASYNC_READ} -eq 1 ] && [ $(stat -c %s -- "${filename}") -ge ${ASYNC_READ_MIN_SIZE} ]
+			then
+				# read ahead in a separate thread, so that reading the file overlaps with decoding
+				source_filename="async:file:${filename}"
+			fi
+
+			# Container, codec and size are all changed with a single ffmpeg pass:
+			# all streams (but data) are copied, only the video is encoded when needed.
+			# The default options select video streams with "V", so attached pictures
+			# (like MP4 cover art) are not encoded or resized but copied with the rest.
+			# subtitles_options converts only the subtitle streams listed in the queue line
+			ffmpeg_options="-map 0 -map -0:d -codec copy${subtitles_options}"
+			if [ $encode -eq 1 -o $resize -eq 1 ]
+			then
+				# resizing needs to encode too, so always use the target codec
+				ffmpeg_options="${ffmpeg_options} ${FFMPEG_ENCODE}"
+				print_notice_nonl "Encoding..."
+				print_log "Encoding from '${source_filename}' to '${gc_filename}'"
+			else
+				print_notice_nonl "Transmuxing..."
+				print_log "Transmuxing from '${source_filename}' to '${gc_filename}'..."
+			fi
+
+			if [ $resize -eq 1 ]
+			then
+				ffmpeg_options="${ffmpeg_options} ${FFMPEG_RESIZE}"
+			fi
+
+			if [ -e "${gc_filename}" ]
+			then
+				# not created by this job, so leave it alone
+				print_notice_nonl " failed! "
+				print_error "Temporary file '${gc_filename}' already exists, not converting."
+				error=1
+			else
+				exec_ffmpeg "${FFMPEG_EXE}" ${FFMPEG_EXTRA_OPTS} -nostdin ${FFMPEG_THREADS_OPTS} -i "${source_filename}" ${FFMPEG_THREADS_OPTS} ${ffmpeg_options} -avoid_negative_ts make_zero ${FFMPEG_MUX_OPTS} "${gc_filename}"
+				if [ $? -eq 0 ]
+				then
+					print_notice_nonl " done. "
+				else
+					print_notice_nonl " failed! "
+					exec_command "${RM_EXE}" -f "${gc_filename}"
+					error=1
+				fi
+			fi
+
+			# Needed to properly go to the next line since all last prints are without newline
+			print_notice " "
+
+			if [ $error -eq 0 ]
+			then
+				if [ -e "${gc_filename}" ]
+				then
+					destination_filename="${stripped_filename}.${CONTAINER_EXTENSION}"
+					print_log "Moving final product from '${gc_filename}' to '${destination_filename}'..."
+					exec_command "${MV_EXE}" "${gc_filename}" "${destination_filename}"
+					if [ $? -eq 0 ]
+					then
+						result=1
+						if [ "${filename}" != "${destination_filename}" ]
+						then
+							print_log "Removing original file..."
+							exec_command "${RM_EXE}" -f "${filename}"
+						else
+							print_log "Original file has been replaced with converted file."
+						fi
+					else
+						print_error "Unable to move converted file, not deleting original."
+					fi
+				else
+					print_error "Missing gc file '${gc_filename}', something went wrong!"
+				fi
+			else
+				print_error "Something went wrong in conversion."
+			fi
+			cd "$my_cwd"
+		else
+			print_error "Unable to cd to '${filepath}'"
+		fi 
+		
+	else
+		print_notice "Nothing to do (!?!?)"
+	fi # change container or encode
+
+	print_log "Removing processed file from processing queue..."
+	if [ ${result} -eq 1 ]
+	then
+		echo "${line}" >&${completed_fd}
+	else
+		echo "${line}" >&${failed_fd}
+	fi
+}
+
+# Videos at least this big are read by ffmpeg with the "async" protocol, if available
+ASYNC_READ_MIN_SIZE=$(( 256 * 1024 * 1024 ))
+
+# Look for a GPU encoder for VIDEO_CODEC, and set FFMPEG_ENCODE to use it
+function detect_hw_encoder()
+{
+	local candidates=
+	local encoder=
+	local encoders=
+
+	case "${VIDEO_CODEC}" in
+		AV1)
+			candidates="av1_nvenc av1_qsv"
+			;;
+		HEVC)
+			candidates="hevc_nvenc hevc_qsv"
+			;;
+		AVC)
+			candidates="h264_nvenc h264_qsv"
+			;;
+	esac
+
+	encoders="$("${FFMPEG_EXE}" -hide_banner -encoders 2> /dev/null)"
+	for encoder in ${candidates}
+	do
+		[[ "${encoders}" == *" ${encoder} "* ]] || continue
+		# ffmpeg lists the encoders it has been built with, so check that the GPU is really there
+		"${FFMPEG_EXE}" -hide_banner -nostdin -f lavfi -i color=black:s=256x256 -frames:v 1 -c:v ${encoder} -f null - &> /dev/null || continue
+		case "${encoder}" in
+			*_nvenc)
+				FFMPEG_ENCODE="-c:V ${encoder} -rc vbr -cq 30 -b:V 0"
+				;;
+			*_qsv)
+				FFMPEG_ENCODE="-c:V ${encoder} -global_quality 30"
+				;;
+		esac
+		return 0
+	done
+	return 255
+}
+
 function print_usage()
 {
 	echo "Media Fixer - Reconvert your videos to your preferred container, codec and sizing"
 	echo "Usage:"
-	echo "   $0 [-l logfile] [-a] [-p path] [-q path] [-r prefix] [-t] [-f] [-d] [-x] [-s] [-i]"
+	echo "   $0 [-l logfile] [-a] [-p path] [-q path] [-r prefix] [-t] [-f] [-d] [-x] [-s] [-i] [-j jobs] [-n threads] [-g]"
 	echo "  -l logfile - use logfile as logfile (optional)"
 	echo "  -q q-path  - folder where the queue files will be stored (optional)"
 	echo "  -r prefix  - prefix to use for personalized queue filenames (optional)"
@@ -341,6 +838,9 @@ function print_usage()
 	echo "  -x         - retry all failed conversions, cannot be enabled with -f"
 	echo "  -s         - only clean stale files and exit (not compatible with -p or -a)"
 	echo "  -i         - wait interactively for confirmation before starting conversions"
+	echo "  -g         - encode with the GPU, if supported (optional)"
+	echo "  -j jobs    - number of videos to convert at the same time, default 1 (optional)"
+	echo "  -n threads - number of threads used by ffmpeg, 0 lets ffmpeg decide (optional)"
 	echo " Either '-a' or '-p' must be present."
 	echo " If '-l' is omitted, the logfile will be in current folder and called 'mediafixer.log'"
 	echo " The queue files are the following:"
@@ -349,6 +849,7 @@ function print_usage()
 	echo "   [q-path/]prefix]mediafixer_queue.completed   = store list of videos successfully converted"
 	echo "   [q-path/]prefix]mediafixer_queue.in_progress = store list of videos under process"
 	echo "   [q-path/]prefix]mediafixer_queue.leftovers   = list of temporary files that you should delete"
+	echo "   [q-path/]prefix]mediafixer_cache             = analysis of already scanned videos"
 	echo " Upon start, if the in_progress queue is not empty, it will be used without re-scanning"
 	echo " all the videos. If you want to force a full rescan, use the -f option."
 }
@@ -384,7 +885,7 @@ then
 	exit 2
 else
 	#### Parse commnand line
-	while getopts "hal:p:q:r:tfdxis" OPTION
+	while getopts "hal:p:q:r:tfdxisj:n:g" OPTION
 	do
 	        case $OPTION in
 	        l)
@@ -426,6 +927,15 @@ else
 		t)
 			TEST_ONLY=1
 			;;
+		g)
+			HW_ENCODE=1
+			;;
+		j)
+			JOBS="${OPTARG}"
+			;;
+		n)
+			FFMPEG_THREADS="${OPTARG}"
+			;;
 	        h|*)
 			print_usage
 	                exit 1
@@ -446,6 +956,35 @@ then
 	exit 254
 fi
 
+if [ "${JOBS}" = "" -o "${JOBS//[[:digit:]]/}" != "" ] || [ ${JOBS} -lt 1 ]
+then
+	echo "ERROR: number of jobs '${JOBS}' is not valid!"
+	exit 254
+fi
+
+if [ "${SCAN_JOBS}" = "" -o "${SCAN_JOBS//[[:digit:]]/}" != "" ] || [ ${SCAN_JOBS} -lt 1 ]
+then
+	echo "ERROR: number of scan jobs '${SCAN_JOBS}' is not valid!"
+	exit 254
+fi
+
+if [ "${FFMPEG_THREADS}" = "" -o "${FFMPEG_THREADS//[[:digit:]]/}" != "" ]
+then
+	echo "ERROR: number of ffmpeg threads '${FFMPEG_THREADS}' is not valid!"
+	exit 254
+fi
+
+# When converting many videos at once, by default share the CPUs between them
+if [ ${FFMPEG_THREADS} -eq 0 -a ${JOBS} -gt 1 ]
+then
+	FFMPEG_THREADS=$(( $(nproc 2> /dev/null || echo 1) / JOBS ))
+	test ${FFMPEG_THREADS} -eq 0 && FFMPEG_THREADS=1
+fi
+
+FFMPEG_THREADS_OPTS=
+# Limit both decoding (before -i) and encoding (after -i) threads
+test ${FFMPEG_THREADS} -gt 0 && FFMPEG_THREADS_OPTS="-threads ${FFMPEG_THREADS}"
+
 # Check valid log file
 test -z "${LOG_FILE}" && LOG_FILE=/dev/null
 
@@ -462,6 +1001,23 @@ test ${RESUME_FAILED} -eq 1 && print_notice "Will retry all failed processing"
 test ${DELETE_OLD_TEMP} -eq 1 && print_notice "Stale temporary files will be deleted"
 test ${ONLY_DELETE_OLD_TEMP} -eq 1 && print_notice "Quit after deleting temp files"
 test ${INTERACTIVE} -eq 1 && print_notice "Interactively wait for confirmation before conversion"
+test ${JOBS} -gt 1 && print_notice "Will convert ${JOBS} videos at the same time"
+test ${FFMPEG_THREADS} -gt 0 && print_notice "Each ffmpeg will use ${FFMPEG_THREADS} threads"
+if [ "${HW_ENCODE}" = "1" ]
+then
+	if [ "${MEDIAFIXER_FFMPEG_ENCODE}" != "" ]
+	then
+		print_notice "GPU encoding not enabled because MEDIAFIXER_FFMPEG_ENCODE is set"
+	elif detect_hw_encoder
+	then
+		print_notice "Will encode with the GPU: '${FFMPEG_ENCODE}'"
+	else
+		print_notice "No GPU encoder found for '${VIDEO_CODEC}', will encode with the CPU"
+	fi
+fi
+# Check if ffmpeg has been built with the "async" protocol
+FFMPEG_ASYNC_READ=0
+[[ "$("${FFMPEG_EXE}" -hide_banner -protocols 2> /dev/null)" == *[[:space:]]async[[:space:]]* ]] && FFMPEG_ASYNC_READ=1
 print_notice "   Base path: '${SCAN_PATH}'"
 print_notice "   Queue path: '${QUEUE_PATH}'"
 
@@ -476,6 +1032,10 @@ print_notice "   Queue path: '${QUEUE_PATH}'"
 
 create_queue=0
 queue_file="${QUEUE_PATH}/${PREFIX}mediafixer_queue"
+cache_file="${QUEUE_PATH}/${PREFIX}mediafixer_cache"
+
+# Remove the lines already popped by a previous run, so that the queue can be read as a whole
+queue_compact ${queue_file}.in_progress
 
 if [ ${RESUME_FAILED} -eq 1 ]
 then
@@ -511,56 +1071,78 @@ then
 		echo -n > ${queue_file}.${j}
 	done
 
+	mediainfo_cache_load "${cache_file}"
+
+	# Open the queues only once, instead of once for each video
+	exec {failed_fd}>> ${queue_file}.failed {skipped_fd}>> ${queue_file}.skipped
+	exec {in_progress_fd}>> ${queue_file}.in_progress {leftovers_fd}>> ${queue_file}.leftovers
+	exec {cache_fd}>> "${cache_file}"
+
+	# Build the find expression matching known video extensions
+	find_video_extensions=()
+	for j in ${VIDEO_EXTENSIONS}
+	do
+		test ${#find_video_extensions[@]} -gt 0 && find_video_extensions+=( -o )
+		find_video_extensions+=( -iname "*.${j}" )
+	done
+
 	print_wait
 	counter=0
-	find . -type f -exec file -N -i -- {} + | sed -n 's!: video/[^:]*$!!p' | {
-	while read line
+	scan_running=0
+	# Known extensions are printed in the same format as "file" output, only the other files are passed to "file".
+	# find has already read modification time and size of the files, print them too to save a stat for each video.
+	find . -type f \( \( "${find_video_extensions[@]}" \) -printf '%p: video/extension %Ts %s\n' -o -exec file -N -i -- {} + \) | {
+	while IFS= read -r line
 	do
+		# Keep only the videos, and remove the mime type from the line
+		case "${line}" in
+			*": video/extension "*)
+				file_stat="${line##*: video/extension }"
+				line="${line%: video/*}"
+				;;
+			*": video/"*)
+				file_stat=
+				line="${line%: video/*}"
+				;;
+			*)
+				continue
+				;;
+		esac
 		counter=$(( counter+1 ))
 		# write a nice running thingy
 	        print_wait
-		# stale temp files end with "mediafixer_working"
-		if [ "${line%mediafixer_working}" = "${line}" ]
+		# stale temp files end with "mediafixer_working" (older versions) or are named
+		# "<original name>.mediafixer_working.<extension>"
+		if [ "${line%mediafixer_working}" = "${line}" -a "${line%.mediafixer_working.*}" = "${line}" ]
 		then
 			if [ ${ONLY_DELETE_OLD_TEMP} -eq 0 ]
 			then
-				result=0
-				change_container=0
-				encode=0
-				resize=0
-				preprocess_video_file "${line}"
-	
-				# Move file to appropriate new queue
-				if [ $result -eq 0 ]
-				then
-					print_log "Video '${line}' added to failed queue"
-					echo ${line} >> ${queue_file}.failed
-				elif [ $result -eq 2 ]
+				# Keep at most SCAN_JOBS analysis running at the same time
+				if [ ${scan_running} -ge ${SCAN_JOBS} ]
 				then
-					print_log "Video '${line}' added to skipped queue"
-					echo ${line} >> ${queue_file}.skipped
-				elif [ $result -eq 1 ]
-				then
-					print_log "Video '${line}' added to processing queue (${change_container} ${encode} ${resize})"
-					echo "${line}|||| ${change_container} ${encode} ${resize}" >> ${queue_file}.in_progress
-				else
-					print_error "Invalid value of '$result' in result!"
+					wait -n
+					scan_running=$(( scan_running-1 ))
 				fi
+				scan_video_file "${file_stat}" "${line}" &
+				scan_running=$(( scan_running+1 ))
 			fi
 		else
 			if [ ${DELETE_OLD_TEMP} -eq 0 ]
 			then
 				print_error "Skipping file '${line}' because it seems a temporary file, you should maybe delete it?"
-				echo ${line} >> ${queue_file}.leftovers
+				echo "${line}" >&${leftovers_fd}
 			else
 				print_log "Removing stale temporary file '${line}'"
 				${RM_EXE} "${line}"
 			fi
 		fi
 	done
+	# Wait for the last analysis jobs to complete
+	wait
+	print_notice "Analyzed ${counter} videos."
 	}
+	exec {failed_fd}>&- {skipped_fd}>&- {in_progress_fd}>&- {leftovers_fd}>&- {cache_fd}>&-
 
-	print_notice "Analyzed ${counter} videos."
 	if [ ${ONLY_DELETE_OLD_TEMP} -eq 1 ]
 	then
 		print_notice "Only delete temporary files: terminating operations."
@@ -582,138 +1164,56 @@ then
 fi
 
 # Iterate the in_progress queue...
-line=$(queue_pop_line ${queue_file}.in_progress)
+exec {completed_fd}>> ${queue_file}.completed {failed_fd}>> ${queue_file}.failed
+running=0
+# destination file of each conversion started, and the job converting it
+declare -A running_destinations
+queue_pop_line ${queue_file}.in_progress
+line="${queue_line}"
 while [ "${line}" != "" ]
 do
-
-	result=0
-
-	full_filename=${line%||||*}
-	filepath="${full_filename%/*}"
-	filename="${full_filename##*/}"
-	extension="${filename##*.}"
-	stripped_filename="${filename%.*}"
-	
-	temp=${line#*||||}
-	change_container=${temp%[[:space:]][[:digit:]][[:space:]][[:digit:]]}
-	encode=${temp%[[:space:]][[:digit:]]}
-	encode=${encode#[[:space:]][[:digit:]][[:space:]]}
-	resize=${temp##[[:space:]][[:digit:]][[:space:]][[:digit:]][[:space:]]}
-
-	print_notice "--- Processing video '$full_filename' [ ${WORKING_LINES} / ${TOTAL_WORK_LINES} ]"
-	WORKING_LINES=$(( WORKING_LINES+1 ))
-
-	if [ $change_container -eq 1 -o $encode -eq 1 -o $resize -eq 1 ]
+	parse_queue_line "${line}"
+	if [ $change_container -eq 0 -a $encode -eq 0 -a $resize -eq 0 ]
 	then
-		result=0
-		my_cwd="$PWD"
-		if cd "${filepath}"
+		# Lines without anything to do come from the failed queue (with -x) for videos which could not be analyzed:
+		# don't even start a job for them, videos are never analyzed again here.
+		print_notice "--- Skipping video '${full_filename}' [ ${WORKING_LINES} / ${TOTAL_WORK_LINES} ]: it was not analyzed, use -f to analyze it again"
+		echo "${line}" >&${failed_fd}
+	else
+		# Videos with the same name but a different extension are converted to the same file:
+		# wait for the conversion already writing it, if any, before starting this one
+		filename="${full_filename##*/}"
+		destination_filename="${full_filename%/*}/${filename%.*}.${CONTAINER_EXTENSION}"
+		pid="${running_destinations[${destination_filename}]}"
+		if [ "${pid}" != "" ] && kill -0 ${pid} 2> /dev/null
 		then
-			error=0
-			gc_filename="${stripped_filename}.mediafixer_working"			
-			print_log "Copying original to '${gc_filename}'..."
-			exec_command "${CP_EXE}" "${filename}" "${gc_filename}" &>> "${LOG_FILE}"
-
-			if [ $change_container -eq 1 ]
-			then 
-				intermediate_filename="${stripped_filename}.tmuxed".${CONTAINER_EXTENSION}
-				print_notice_nonl "Transmuxing..."
-				print_log "Transmuxing from '${gc_filename}' to '${intermediate_filename}'..."
-				exec_command "${FFMPEG_EXE}" -fflags +genpts -nostdin -find_stream_info -i "${gc_filename}" -map 0 -map -0:d -codec copy -codec:s srt "${intermediate_filename}" &>> "${LOG_FILE}"
-				if [ $? -eq 0 ]
-				then
-					print_notice_nonl " done. "
-					exec_command "${MV_EXE}" "${intermediate_filename}" "${gc_filename}" &>> "${LOG_FILE}"
-				else
-					print_notice_nonl " failed! "
-					exec_command "${RM_EXE}" -f "${intermediate_filename}"
-					error=1
-				fi
-			fi # transmux
-
-			if [ $error -eq 0 ]
-			then
-				if [ $encode -eq 1 -o $resize -eq 1 ]
-				then
-					source_filename="${gc_filename}"
-					intermediate_filename="${stripped_filename}.encoded".${CONTAINER_EXTENSION}
-					print_notice_nonl "Encoding..."
-					print_log "Encoding from '${source_filename}' to '${intermediate_filename}'" 
-
-					ffmpeg_options=
-					if [ $encode -eq 1 ]
-					then
-						ffmpeg_options=${FFMPEG_ENCODE}
-					fi
-	
-					if [ $resize -eq 1 ]
-					then
-						ffmpeg_options="${ffmpeg_options} ${FFMPEG_RESIZE}"
-					fi
-
-					exec_command "${FFMPEG_EXE}" -fflags +genpts -nostdin -i "${source_filename}" ${ffmpeg_options} "${intermediate_filename}"
-					if [ $? -eq 0 ]
-					then
-						print_notice_nonl " done. "
-						exec_command "${MV_EXE}" "${intermediate_filename}" "${gc_filename}"
-					else
-						print_notice_nonl " failed! "
-						exec_command "${RM_EXE}" -f "${intermediate_filename}"
-						error=1
-					fi
-				fi # encore or resize
-			fi # error = 0
-
-			# Needed to properly go to the next line since all last prints are without newline
-			print_notice " "
+			print_log "Waiting for the conversion to '${destination_filename}' to complete..."
+			wait ${pid}
+			running=$(( running-1 ))
+		fi
 
-			if [ $error -eq 0 ]
-			then
-				if [ -e "${gc_filename}" ]
-				then
-					destination_filename="${stripped_filename}.${CONTAINER_EXTENSION}"
-					print_log "Moving final product from '${gc_filename}' to '${destination_filename}'..."
-					exec_command "${MV_EXE}" "${gc_filename}" "${destination_filename}"
-					if [ $? -eq 0 ]
-					then
-						result=1
-						if [ "${filename}" != "${destination_filename}" ]
-						then
-							print_log "Removing original file..."
-							exec_command "${RM_EXE}" -f "${filename}"
-						else
-							print_log "Original file has been replaced with converted file."
-						fi
-					else
-						print_error "Unable to move converted file, not deleting original."
-					fi
-				else
-					print_error "Missing gc file '${working_filename}', something went wrong!"
-				fi
-			else
-				print_error "Something went wrong in conversion."
-			fi
-			cd "$my_cwd"
-		else
-			print_error "Unable to cd to '${filepath}'"
-		fi 
-		
-	else
-		print_notice "Nothing to do (!?!?)"
-	fi # change container or encode
+		# Keep at most JOBS conversions running at the same time
+		if [ ${running} -ge ${JOBS} ]
+		then
+			wait -n
+			running=$(( running-1 ))
+		fi
 
-	print_log "Removing processed file from processing queue..."
-	if [ ${result} -eq 1 ]
-	then
-		echo ${line} >> ${queue_file}.completed
-	else
-		echo ${line} >> ${queue_file}.failed
+		print_notice "--- Processing video '${full_filename}' [ ${WORKING_LINES} / ${TOTAL_WORK_LINES} ]"
+		process_video_line "${line}" &
+		running_destinations["${destination_filename}"]=$!
+		running=$(( running+1 ))
 	fi
+	WORKING_LINES=$(( WORKING_LINES+1 ))
 
 	# remove from queue
-	line=$(queue_pop_line ${queue_file}.in_progress)
+	queue_pop_line ${queue_file}.in_progress
+	line="${queue_line}"
 
 done
+# Wait for the last conversions to complete
+wait
+exec {completed_fd}>&- {failed_fd}>&-
 
 }) # moved to SCAN_PATH
 